@@ -1,21 +1,29 @@
 import asyncio
+import concurrent.futures
+import io
 import logging
+import mmap
 import os
 import re
 import sys
-from collections import defaultdict
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Deque, Tuple, Callable, Awaitable
 
 import aiohttp
+import orjson
 from aiogram import Bot, Dispatcher, F
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, FSInputFile
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, BufferedInputFile
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-from pydub import AudioSegment
+import xlsxwriter
+
+import conv_store
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -39,12 +47,129 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GROQ_WHISPER_URL = "https://api.groq.com/openai/v1/audio/transcriptions"
 PROMPT_FILE = "prompt.md"
 MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "10"))  # Максимум сообщений в истории
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "6000"))  # Бюджет токенов истории в запросе к LLM
+PHOTO_MARKER = "[Пользователь отправил фото экзаменационной работы/материала]"  # Запись о фото в истории
+PHOTO_KEEP_TURNS = 2  # Сколько последних реплик пользователя хранят запись о фото целиком
+ARCHIVED_TURNS_MARKER = "[Более ранние сообщения диалога опущены]"  # Замена вытесненных сообщений
+CONVERSATIONS_DB = os.getenv("CONVERSATIONS_DB", "conversations.db")  # Файл SQLite с историей диалогов
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "3600"))  # Секунд без сообщений до выгрузки диалога из памяти
+MESSAGE_PART_LENGTH = 3500  # Максимальная длина одного сообщения ответа (лимит Telegram — 4096)
+STREAM_EDIT_INTERVAL = 1.0  # Минимальный интервал между обновлениями ответа в чате (секунды)
+
+# Регулярные выражения для разбора финального отчёта
+MD_BOLD_RE = re.compile(r'\*\*')  # markdown-выделение **
+# Пункт отчёта "1. Заголовок: содержимое" — от строки "число." до следующей такой строки или конца текста.
+# Первый пункт может идти после отступа в начале текста. Пункт с пустым заголовком ("2. : текст")
+# сохраняется с пустым заголовком, а пустой пункт ("8. " без текста) пропускается.
+REPORT_POINT_RE = re.compile(
+    r'(?:^|\A\s+)(\d+)\.(?:(?!\n\d+\.)\s)*'
+    r'([^:\s][^:\n]*|[^\S\n]+(?=(?:(?!\n\d+\.)\s)*\S))'
+    r':?(?:(?!\n\d+\.)\s)*(.*?)(?=\n\d+\.|\Z)',
+    re.MULTILINE | re.DOTALL
+)
+
+# Имя ученика: слово с заглавной буквы сразу после ключевого слова ("зовут", "имя", "ученик(а)", "ученица")
+STUDENT_NAME_RE = re.compile(
+    r'(?i:зовут|имя|учени[кц][а-яё]*)[^A-Za-zА-Яа-яЁё]{0,40}([А-ЯЁ][а-яё]{2,})'
+)
 
 # Глобальная переменная для системного промпта
 SYSTEM_PROMPT: Optional[str] = None
 
-# История диалогов для каждого пользователя: {user_id: [{"role": "user/assistant", "content": "..."}]}
-user_conversations: Dict[int, List[Dict[str, str]]] = defaultdict(list)
+# Основная клавиатура с кнопками управления (создаётся один раз и переиспользуется)
+MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [
+            KeyboardButton(text="➡️ Следующий ученик"),
+            KeyboardButton(text="📊 Экспорт в Excel")
+        ]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
+
+# Структура отчёта (после /start)
+REPORT_STRUCTURE_TEXT = (
+    "📋 **Структура отчёта (8 пунктов):**\n\n"
+    "**1. Работа ученика на занятиях.** Общее впечатление за месяц "
+    "(вовлеченность в процесс занятия, каким образом проявлял активность за месяц)\n\n"
+    "**2. Работа с домашними заданиями** (впечатление от качества выполнения домашних заданий за месяц)\n\n"
+    "**3. Комментарий к экзаменационной работе**\n\n"
+    "**4. Ожидаемый результат на этот месяц**\n\n"
+    "**5. Причины отсутствия прироста и неудовлетворительного результата**\n\n"
+    "**6. Рекомендации на будущий месяц ребёнку**\n\n"
+    "**7. Рекомендации родителям**\n\n"
+    "**8. Дополнительные комментарии**\n\n"
+    "━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+    "⚠️ **Важно:**\n"
+    "• Обязательно скажите, **про кого идет речь** и **какой месяц**.\n"
+    "• Отчёт получится лучше, если будете записывать **с экзаменационной работой на руках**.\n"
+    "• Старайтесь рассказывать подробно **в баллах** и **в номерах заданий** — обязательно упомяните."
+)
+
+# Краткая структура отчёта (при переходе к следующему ученику)
+REPORT_STRUCTURE_SHORT_TEXT = (
+    "📋 **Структура отчёта (8 пунктов):**\n\n"
+    "1. Работа ученика на занятиях\n"
+    "2. Работа с домашними заданиями\n"
+    "3. Комментарий к экзаменационной работе\n"
+    "4. Ожидаемый результат на этот месяц\n"
+    "5. Причины отсутствия прироста\n"
+    "6. Рекомендации ребёнку\n"
+    "7. Рекомендации родителям\n"
+    "8. Дополнительные комментарии\n\n"
+    "━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+    "💬 **Какой месяц отчёта?**\n"
+    "💬 **Как зовут ученика?**"
+)
+
+# Пул потоков для формирования Excel файлов (блокирующая работа вне event loop)
+EXCEL_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="excel")
+
+# Общая HTTP-сессия для запросов к OpenRouter и Groq (создаётся в main())
+HTTP: Optional[aiohttp.ClientSession] = None
+
+
+
+@dataclass
+class UserState:
+    """Состояние диалога пользователя: история и данные для экспорта отчёта"""
+    # Последние N сообщений [{"role": "user/assistant", "content": "..."}], старые вытесняются автоматически
+    history: Deque[Dict[str, str]] = field(default_factory=lambda: deque(maxlen=MAX_HISTORY_MESSAGES))
+    student_name: Optional[str] = None  # Имя ученика, найденное в сообщениях пользователя
+    final_report: Optional[str] = None  # Последний ответ бота с финальным отчётом (8 пунктов)
+    user_msgs: int = 0  # Сообщений пользователя в истории
+    assistant_msgs: int = 0  # Ответов бота в истории
+    
+    def add(self, role: str, content: str) -> None:
+        """Добавляет сообщение и обновляет данные для экспорта отчёта"""
+        # deque(maxlen=N) хранит последние N сообщений (не считая системный промпт),
+        # поэтому вытесняемое сообщение вычитаем из счётчиков
+        if len(self.history) == self.history.maxlen:
+            self._count(self.history[0]['role'], -1)
+        self.history.append({"role": role, "content": content})
+        self._count(role, 1)
+        
+        # Обновляем данные для экспорта сразу, чтобы не сканировать историю при каждом экспорте
+        if role == 'user':
+            student_name = extract_student_name(content)
+            if student_name:
+                self.student_name = student_name
+        elif role == 'assistant' and is_final_report(content):
+            self.final_report = content
+    
+    def _count(self, role: str, delta: int) -> None:
+        """Обновляет счётчик сообщений для роли"""
+        if role == 'user':
+            self.user_msgs += delta
+        elif role == 'assistant':
+            self.assistant_msgs += delta
+
+
+# Активные диалоги в памяти: {user_id: UserState}.
+# Диалог без новых сообщений дольше USER_STATE_TTL выгружается и при следующем
+# обращении восстанавливается из conv_store.
+user_conversations: TTLCache = TTLCache(maxsize=1000, ttl=USER_STATE_TTL)
 
 
 def load_system_prompt() -> bool:
@@ -54,23 +179,30 @@ def load_system_prompt() -> bool:
     try:
         prompt_path = Path(PROMPT_FILE)
         if not prompt_path.exists():
-            logger.error(f"Файл {PROMPT_FILE} не найден!")
+            logger.error("Файл %s не найден!", PROMPT_FILE)
             return False
         
-        SYSTEM_PROMPT = prompt_path.read_text(encoding='utf-8').strip()
-        logger.info(f"Системный промпт успешно загружен из {PROMPT_FILE}")
+        # Читаем файл через mmap: страницы берутся прямо из page cache ОС без
+        # промежуточного буфера чтения (пустой файл отобразить нельзя)
+        with prompt_path.open('rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                SYSTEM_PROMPT = ""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    SYSTEM_PROMPT = mm[:].decode('utf-8').strip()
+        logger.info("Системный промпт успешно загружен из %s", PROMPT_FILE)
         return True
     except Exception as e:
-        logger.error(f"Ошибка при загрузке системного промпта: {e}")
+        logger.error("Ошибка при загрузке системного промпта: %s", e)
         return False
 
 
-async def transcribe_audio(audio_path: str) -> Optional[str]:
+async def transcribe_audio(audio_data: bytes) -> Optional[str]:
     """
-    Транскрибирует аудиофайл в текст используя Groq Whisper API (БЕСПЛАТНО!).
+    Транскрибирует аудио в текст используя Groq Whisper API (БЕСПЛАТНО!).
     
     Args:
-        audio_path: Путь к аудиофайлу
+        audio_data: Содержимое голосового сообщения (OGG/Opus)
         
     Returns:
         Транскрибированный текст или None в случае ошибки
@@ -79,60 +211,86 @@ async def transcribe_audio(audio_path: str) -> Optional[str]:
         logger.error("Groq API ключ не установлен! Голосовые сообщения недоступны.")
         return None
     
-    mp3_path = None
     try:
-        # Конвертируем аудио в формат MP3 для Whisper
-        audio = AudioSegment.from_file(audio_path)
-        mp3_path = audio_path.replace('.oga', '.mp3')
-        audio.export(mp3_path, format="mp3")
-        logger.info(f"Аудио сконвертировано в MP3: {mp3_path}")
-        
-        # Отправляем запрос к OpenAI Whisper API
-        async with aiohttp.ClientSession() as session:
-            with open(mp3_path, 'rb') as audio_file:
-                form_data = aiohttp.FormData()
-                form_data.add_field('file', audio_file, filename='audio.mp3', content_type='audio/mpeg')
-                form_data.add_field('model', 'whisper-large-v3')
-                form_data.add_field('language', 'ru')  # Русский язык (можно удалить для автоопределения)
-                
-                headers = {
-                    'Authorization': f'Bearer {GROQ_API_KEY}'
-                }
+        # Groq Whisper принимает OGG/Opus напрямую — отправляем без перекодирования
+        form_data = aiohttp.FormData()
+        form_data.add_field('file', audio_data, filename='audio.ogg', content_type='audio/ogg')
+        form_data.add_field('model', 'whisper-large-v3')
+        form_data.add_field('language', 'ru')  # Русский язык (можно удалить для автоопределения)
+        
+        headers = {
+            'Authorization': f'Bearer {GROQ_API_KEY}'
+        }
+        
+        async with HTTP.post(
+            GROQ_WHISPER_URL,
+            headers=headers,
+            data=form_data
+        ) as response:
+            if response.status == 200:
+                result = orjson.loads(await response.read())
+                text = result.get('text', '').strip()
+                logger.info("Аудио успешно транскрибировано через Groq: %.100s...", text)
+                return text
+            else:
+                error_text = await response.text()
+                logger.error("Ошибка транскрипции Groq Whisper API: %d - %s", response.status, error_text)
+                return None
                 
-                async with session.post(
-                    GROQ_WHISPER_URL,
-                    headers=headers,
-                    data=form_data
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        text = result.get('text', '').strip()
-                        logger.info(f"Аудио успешно транскрибировано через Groq: {text[:100]}...")
-                        
-                        # Удаляем временные файлы
-                        os.remove(audio_path)
-                        os.remove(mp3_path)
-                        
-                        return text
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка транскрипции Groq Whisper API: {response.status} - {error_text}")
-                        return None
-                        
     except Exception as e:
-        logger.error(f"Ошибка при транскрибации аудио: {e}")
-        # Очищаем временные файлы в случае ошибки
-        try:
-            if audio_path and os.path.exists(audio_path):
-                os.remove(audio_path)
-            if mp3_path and os.path.exists(mp3_path):
-                os.remove(mp3_path)
-        except Exception as cleanup_error:
-            logger.error(f"Ошибка при удалении временных файлов: {cleanup_error}")
+        logger.error("Ошибка при транскрибации аудио: %s", e)
         return None
 
 
-def add_to_history(user_id: int, role: str, content: str) -> None:
+def extract_student_name(content: str) -> Optional[str]:
+    """
+    Ищет имя ученика в сообщении пользователя.
+    
+    Args:
+        content: Текст сообщения пользователя
+        
+    Returns:
+        Имя ученика или None, если сообщение его не содержит
+    """
+    # Один проход регулярного выражения: ключевое слово и имя сразу после него
+    match = STUDENT_NAME_RE.search(content)
+    return match.group(1) if match else None
+
+
+def is_final_report(content: str) -> bool:
+    """Проверяет, что ответ бота — финальный отчёт с 8 пунктами"""
+    return '1.' in content and '8.' in content
+
+
+async def get_user_state(user_id: int) -> UserState:
+    """
+    Получает состояние диалога пользователя, при необходимости загружая его из хранилища.
+    
+    Args:
+        user_id: ID пользователя Telegram
+        
+    Returns:
+        UserState пользователя
+    """
+    state = user_conversations.get(user_id)
+    if state is None:
+        state = UserState()
+        for msg in await conv_store.fetch(user_id):
+            state.add(msg['role'], msg['content'])
+        # Имя и отчёт могли быть найдены в уже вытесненных из истории сообщениях
+        meta = await conv_store.fetch_meta(user_id)
+        if meta:
+            state.student_name, state.final_report = meta
+        # Пока шла загрузка, параллельное обновление того же пользователя (например, альбом)
+        # могло уже загрузить состояние и дописать в него сообщение — используем его
+        loaded = user_conversations.get(user_id)
+        if loaded is not None:
+            return loaded
+        user_conversations[user_id] = state
+    return state
+
+
+async def add_to_history(user_id: int, role: str, content: str) -> None:
     """
     Добавляет сообщение в историю пользователя.
     
@@ -141,27 +299,32 @@ def add_to_history(user_id: int, role: str, content: str) -> None:
         role: Роль ('user' или 'assistant')
         content: Текст сообщения
     """
-    user_conversations[user_id].append({"role": role, "content": content})
+    state = await get_user_state(user_id)
+    export_data = (state.student_name, state.final_report)
+    state.add(role, content)
     
-    # Ограничиваем историю последними N сообщениями (не считая системный промпт)
-    if len(user_conversations[user_id]) > MAX_HISTORY_MESSAGES:
-        user_conversations[user_id] = user_conversations[user_id][-MAX_HISTORY_MESSAGES:]
+    # Повторная запись продлевает TTL активного диалога
+    user_conversations[user_id] = state
+    await conv_store.append(user_id, {"role": role, "content": content})
+    if (state.student_name, state.final_report) != export_data:
+        await conv_store.save_meta(user_id, state.student_name, state.final_report)
     
-    logger.info(f"История пользователя {user_id}: {len(user_conversations[user_id])} сообщений")
+    logger.debug("История пользователя %s: %d сообщений", user_id, len(state.history))
 
 
-def clear_history(user_id: int) -> None:
+async def clear_history(user_id: int) -> None:
     """
     Очищает историю диалога пользователя.
     
     Args:
         user_id: ID пользователя Telegram
     """
-    user_conversations[user_id] = []
-    logger.info(f"История пользователя {user_id} очищена")
+    user_conversations[user_id] = UserState()
+    await conv_store.clear(user_id)
+    logger.info("История пользователя %s очищена", user_id)
 
 
-def get_conversation_history(user_id: int) -> List[Dict[str, str]]:
+async def get_conversation_history(user_id: int) -> List[Dict[str, str]]:
     """
     Получает историю диалога пользователя.
     
@@ -171,30 +334,115 @@ def get_conversation_history(user_id: int) -> List[Dict[str, str]]:
     Returns:
         Список сообщений в формате [{"role": "user/assistant", "content": "..."}]
     """
-    return user_conversations[user_id]
+    state = await get_user_state(user_id)
+    return list(state.history)
 
 
-def create_main_keyboard() -> ReplyKeyboardMarkup:
+def parse_report_points(final_report: str) -> List[Tuple[str, str, str]]:
     """
-    Создает основную клавиатуру с кнопками управления.
+    Разбирает финальный отчёт на пронумерованные пункты.
     
+    Args:
+        final_report: Текст финального отчёта от LLM
+        
     Returns:
-        ReplyKeyboardMarkup с кнопками
+        Список кортежей (номер пункта, заголовок, содержимое)
     """
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="➡️ Следующий ученик"),
-                KeyboardButton(text="📊 Экспорт в Excel")
-            ]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False
-    )
-    return keyboard
+    parsed_points = []
+    
+    # Убираем markdown форматирование (** и т.д.)
+    clean_report = MD_BOLD_RE.sub('', final_report)
+    
+    logger.debug("Длина отчёта: %d символов", len(clean_report))
+    
+    # Один проход по тексту: каждое совпадение — пункт с номером, заголовком и содержимым
+    for match in REPORT_POINT_RE.finditer(clean_report):
+        point_num = match.group(1)
+        point_title = match.group(2).strip()
+        point_content = match.group(3).strip()
+        
+        logger.debug("Найден пункт #%s: %s", point_num, point_title)
+        parsed_points.append((point_num, point_title, point_content))
+    
+    logger.debug("Найдено пунктов: %d", len(parsed_points))
+    
+    return parsed_points
 
 
-async def export_to_excel(user_id: int) -> Optional[str]:
+def build_report_workbook(final_report: str, student_name: Optional[str]) -> bytes:
+    """
+    Формирует Excel файл с финальным отчётом в памяти.
+    
+    Блокирующая функция: вызывается в EXCEL_POOL, чтобы не останавливать event loop.
+    
+    Args:
+        final_report: Текст финального отчёта от LLM
+        student_name: Имя ученика для заголовка или None
+        
+    Returns:
+        Содержимое .xlsx файла
+    """
+    # Создаем новую книгу целиком в памяти (in_memory: без временных файлов на диске)
+    buffer = io.BytesIO()
+    wb = xlsxwriter.Workbook(buffer, {'in_memory': True, 'strings_to_urls': False})
+    ws = wb.add_worksheet("Отчет преподавателя")
+    
+    # Настройка стилей (форматы создаются один раз и переиспользуются для всех ячеек)
+    title_fmt = wb.add_format({
+        'bold': True, 'font_size': 14,
+        'align': 'center', 'valign': 'vcenter'
+    })
+    header_fmt = wb.add_format({
+        'bold': True, 'font_size': 12, 'font_color': 'white', 'bg_color': '#366092',
+        'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'border': 1
+    })
+    point_title_fmt = wb.add_format({
+        'bold': True, 'font_size': 11,
+        'valign': 'top', 'text_wrap': True, 'border': 1
+    })
+    cell_fmt = wb.add_format({
+        'font_size': 11,
+        'valign': 'top', 'text_wrap': True, 'border': 1
+    })
+    
+    # Ширина столбцов
+    ws.set_column('A:A', 45)
+    ws.set_column('B:B', 80)
+    
+    # Заголовок документа
+    title = f"Отчет преподавателя"
+    if student_name:
+        title += f" - {student_name}"
+    title += f" - {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+    ws.set_row(0, 25)
+    ws.merge_range('A1:B1', title, title_fmt)
+    
+    # Заголовки таблицы
+    ws.set_row(1, 30)
+    ws.write(1, 0, "Пункт отчёта", header_fmt)
+    ws.write(1, 1, "Комментарий", header_fmt)
+    
+    # Пункты отчёта: по одной строке таблицы на пункт
+    row = 2
+    for point_num, point_title, point_content in parse_report_points(final_report):
+        # Автоматическая высота строки (задаётся до записи ячеек строки)
+        ws.set_row(row, max(60, len(point_content) // 4))
+        
+        # Заголовок пункта
+        ws.write(row, 0, f"{point_num}. {point_title}", point_title_fmt)
+        
+        # Содержимое пункта
+        ws.write(row, 1, point_content, cell_fmt)
+        
+        row += 1
+    
+    logger.info("Всего добавлено строк в Excel: %d", row - 2)
+    
+    wb.close()
+    return buffer.getvalue()
+
+
+async def export_to_excel(user_id: int) -> Optional[Tuple[bytes, str]]:
     """
     Экспортирует финальный отчёт (8 пунктов) в Excel файл.
     
@@ -202,142 +450,17 @@ async def export_to_excel(user_id: int) -> Optional[str]:
         user_id: ID пользователя Telegram
         
     Returns:
-        Путь к созданному файлу или None в случае ошибки
+        Кортеж (содержимое файла, имя файла) или None в случае ошибки
     """
-    history = get_conversation_history(user_id)
+    state = await get_user_state(user_id)
+    final_report = state.final_report
+    student_name = state.student_name
     
-    if not history:
+    if not final_report:
         return None
     
     try:
-        # Ищем последний ответ бота с финальным отчётом
-        final_report = None
-        student_name = None
-        
-        # Ищем имя ученика в истории
-        for msg in history:
-            if msg['role'] == 'user':
-                # Ищем упоминание имени после вопросов об имени
-                content_lower = msg['content'].lower()
-                if any(word in content_lower for word in ['зовут', 'имя', 'ученик', 'ученица']):
-                    # Пытаемся извлечь имя (первое слово с заглавной буквы после ключевых слов)
-                    words = msg['content'].split()
-                    for i, word in enumerate(words):
-                        if word and word[0].isupper() and len(word) > 2 and word.isalpha():
-                            student_name = word
-                            break
-        
-        for msg in reversed(history):
-            if msg['role'] == 'assistant':
-                # Проверяем что это отчёт с 8 пунктами
-                if '1.' in msg['content'] and '8.' in msg['content']:
-                    final_report = msg['content']
-                    break
-        
-        if not final_report:
-            return None
-        
-        # Создаем новую книгу
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Отчет преподавателя"
-        
-        # Настройка стилей
-        header_font = Font(bold=True, size=12, color="FFFFFF")
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-        
-        cell_font = Font(size=11)
-        cell_alignment = Alignment(vertical="top", wrap_text=True)
-        
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        
-        # Заголовок документа
-        ws.merge_cells('A1:B1')
-        title = f"Отчет преподавателя"
-        if student_name:
-            title += f" - {student_name}"
-        title += f" - {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-        ws['A1'] = title
-        ws['A1'].font = Font(bold=True, size=14)
-        ws['A1'].alignment = Alignment(horizontal="center", vertical="center")
-        ws.row_dimensions[1].height = 25
-        
-        # Заголовки таблицы
-        ws['A2'] = "Пункт отчёта"
-        ws['B2'] = "Комментарий"
-        
-        for cell in ['A2', 'B2']:
-            ws[cell].font = header_font
-            ws[cell].fill = header_fill
-            ws[cell].alignment = header_alignment
-            ws[cell].border = border
-        
-        ws.row_dimensions[2].height = 30
-        
-        # Ширина столбцов
-        ws.column_dimensions['A'].width = 45
-        ws.column_dimensions['B'].width = 80
-        
-        # Парсим отчёт на 8 пунктов
-        row = 3
-        
-        # Убираем markdown форматирование (** и т.д.)
-        clean_report = re.sub(r'\*\*', '', final_report)
-        
-        # Ищем все пункты с номерами от 1 до 8
-        logger.info(f"Начало парсинга отчёта для пользователя {user_id}")
-        logger.info(f"Длина отчёта: {len(clean_report)} символов")
-        
-        # Разбиваем по паттерну "число."
-        points = re.split(r'\n(?=\d+\.)', clean_report)
-        logger.info(f"Найдено частей после split: {len(points)}")
-        
-        for i, point in enumerate(points, 1):
-            point = point.strip()
-            if not point:
-                logger.info(f"Пункт {i} пустой, пропускаем")
-                continue
-            
-            logger.info(f"Обработка пункта {i}: {point[:100]}...")
-            
-            # Извлекаем заголовок пункта и содержимое
-            # Паттерн: "1. Заголовок" или "1. Заголовок:" далее содержимое
-            match = re.match(r'^(\d+)\.\s*([^:\n]+):?\s*(.*)', point, re.DOTALL)
-            if match:
-                point_num = match.group(1)
-                point_title = match.group(2).strip()
-                point_content = match.group(3).strip()
-                
-                logger.info(f"Найден пункт #{point_num}: {point_title}")
-                
-                # Заголовок пункта
-                ws[f'A{row}'] = f"{point_num}. {point_title}"
-                ws[f'A{row}'].font = Font(bold=True, size=11)
-                ws[f'A{row}'].alignment = cell_alignment
-                ws[f'A{row}'].border = border
-                
-                # Содержимое пункта
-                ws[f'B{row}'] = point_content
-                ws[f'B{row}'].font = cell_font
-                ws[f'B{row}'].alignment = cell_alignment
-                ws[f'B{row}'].border = border
-                
-                # Автоматическая высота строки
-                ws.row_dimensions[row].height = max(60, len(point_content) // 4)
-                
-                row += 1
-            else:
-                logger.warning(f"Пункт {i} не совпал с паттерном: {point[:100]}")
-        
-        logger.info(f"Всего добавлено строк в Excel: {row - 3}")
-        
-        # Сохраняем файл с именем формата: ОТЧЕТ_ФАМИЛИЯ_ИМЯ.xlsx
+        # Имя файла формата: ОТЧЕТ_ФАМИЛИЯ_ИМЯ.xlsx
         if student_name:
             # Преобразуем имя в заглавные буквы для имени файла
             student_name_upper = student_name.upper()
@@ -346,23 +469,80 @@ async def export_to_excel(user_id: int) -> Optional[str]:
             # Если имя не найдено, используем ID и дату
             filename = f"ОТЧЕТ_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
         
-        wb.save(filename)
+        # Формирование книги выполняется в отдельном потоке
+        logger.info("Начало парсинга отчёта для пользователя %s", user_id)
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(EXCEL_POOL, build_report_workbook, final_report, student_name)
         
-        logger.info(f"Создан Excel файл: {filename}")
-        return filename
+        logger.info("Создан Excel файл: %s (%d байт)", filename, len(data))
+        return data, filename
         
     except Exception as e:
-        logger.error(f"Ошибка при создании Excel файла: {e}")
+        logger.error("Ошибка при создании Excel файла: %s", e)
         return None
 
 
-async def get_llm_response(user_id: int, user_message: str) -> Optional[str]:
+def approx_tokens(text: str) -> int:
+    """Грубая оценка количества токенов в тексте (~4 символа на токен)"""
+    return max(1, len(text) // 4)
+
+
+def fit_history_to_budget(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Оставляет из истории самые свежие сообщения, укладывающиеся в MAX_CONTEXT_TOKENS.
+    
+    Args:
+        history: История диалога от старых сообщений к новым
+        
+    Returns:
+        Сообщения для запроса к LLM; вытесненные заменяются одним маркером
+    """
+    kept = []
+    total_tokens = 0
+    user_turns = 0
+    
+    # Идём от новых сообщений к старым
+    for msg in reversed(history):
+        content = msg['content']
+        
+        if msg['role'] == 'user':
+            user_turns += 1
+            # Старые записи о фото сжимаем до подписи, а без подписи убираем совсем
+            if user_turns > PHOTO_KEEP_TURNS and content.startswith(PHOTO_MARKER):
+                content = content[len(PHOTO_MARKER):].strip()
+                if not content:
+                    continue
+                msg = {'role': 'user', 'content': content}
+        
+        tokens = approx_tokens(content)
+        # Самое свежее сообщение (текущий запрос пользователя) сохраняем всегда
+        if kept and total_tokens + tokens > MAX_CONTEXT_TOKENS:
+            break
+        
+        kept.append(msg)
+        total_tokens += tokens
+    else:
+        # Вся история уместилась в бюджет
+        return kept[::-1]
+    
+    logger.info("История обрезана до %d сообщений (~%d токенов)", len(kept), total_tokens)
+    return [{'role': 'system', 'content': ARCHIVED_TURNS_MARKER}] + kept[::-1]
+
+
+async def get_llm_response(
+    user_id: int,
+    user_message: str,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None
+) -> Optional[str]:
     """
     Отправляет запрос к OpenRouter API и получает ответ от LLM с учетом истории диалога.
     
+    Ответ принимается потоком (SSE), каждый новый фрагмент передаётся в on_delta.
+    
     Args:
         user_id: ID пользователя Telegram
         user_message: Текст сообщения пользователя
+        on_delta: Корутина, вызываемая для каждого нового фрагмента ответа
         
     Returns:
         Ответ от LLM или None в случае ошибки
@@ -373,51 +553,83 @@ async def get_llm_response(user_id: int, user_message: str) -> Optional[str]:
     
     try:
         # Добавляем новое сообщение пользователя в историю
-        add_to_history(user_id, "user", user_message)
+        await add_to_history(user_id, "user", user_message)
         
         # Получаем историю диалога
-        conversation_history = get_conversation_history(user_id)
+        conversation_history = await get_conversation_history(user_id)
         
         headers = {
             'Authorization': f'Bearer {OPENROUTER_API_KEY}',
             'Content-Type': 'application/json',
+            'Accept': 'text/event-stream',
             'HTTP-Referer': 'https://github.com/your-repo',
             'X-Title': 'Telegram AI Bot'
         }
         
-        # Формируем сообщения: системный промпт + история диалога
+        # Формируем сообщения: системный промпт + история диалога в пределах бюджета токенов
         messages = [
             {'role': 'system', 'content': SYSTEM_PROMPT}
-        ] + conversation_history
+        ] + fit_history_to_budget(conversation_history)
         
         payload = {
             'model': OPENROUTER_MODEL,
             'messages': messages,
-            'max_tokens': 4000  # Увеличили для длинных ответов
+            'max_tokens': 4000,  # Увеличили для длинных ответов
+            'stream': True  # Получаем ответ по мере генерации
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                OPENROUTER_API_URL,
-                headers=headers,
-                json=payload
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    answer = data['choices'][0]['message']['content']
-                    logger.info(f"Получен ответ от LLM (длина: {len(answer)} символов)")
+        async with HTTP.post(
+            OPENROUTER_API_URL,
+            headers=headers,
+            data=orjson.dumps(payload)  # Content-Type: application/json задан в заголовках
+        ) as response:
+            if response.status == 200:
+                answer_chunks = []
+                
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
                     
-                    # Добавляем ответ ассистента в историю
-                    add_to_history(user_id, "assistant", answer)
+                    # Пустые строки разделяют события, строки с ":" — служебные комментарии
+                    if not line.startswith('data: '):
+                        continue
                     
-                    return answer
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Ошибка API OpenRouter: {response.status} - {error_text}")
-                    return None
+                    event = line[len('data: '):]
+                    if event == '[DONE]':
+                        break
                     
+                    data = orjson.loads(event)
+                    if 'error' in data:
+                        logger.error("Ошибка API OpenRouter во время генерации: %s", data['error'])
+                        return None
+                    
+                    # Служебные события (например, итоговый usage) приходят без choices/delta
+                    choices = data.get('choices') or []
+                    if not choices:
+                        continue
+                    delta = (choices[0].get('delta') or {}).get('content')
+                    if delta:
+                        answer_chunks.append(delta)
+                        if on_delta:
+                            await on_delta(delta)
+                
+                answer = ''.join(answer_chunks)
+                if not answer:
+                    logger.error("OpenRouter вернул пустой ответ")
+                    return None
+                
+                logger.info("Получен ответ от LLM (длина: %d символов)", len(answer))
+                
+                # Добавляем ответ ассистента в историю
+                await add_to_history(user_id, "assistant", answer)
+                
+                return answer
+            else:
+                error_text = await response.text()
+                logger.error("Ошибка API OpenRouter: %d - %s", response.status, error_text)
+                return None
+                
     except Exception as e:
-        logger.error(f"Ошибка при обращении к LLM: {e}")
+        logger.error("Ошибка при обращении к LLM: %s", e)
         return None
 
 
@@ -430,7 +642,7 @@ dp = Dispatcher()
 async def cmd_start(message: Message):
     """Обработчик команды /start"""
     user_id = message.from_user.id
-    clear_history(user_id)  # Очищаем историю при старте
+    await clear_history(user_id)  # Очищаем историю при старте
     
     # Приветствие
     greeting = (
@@ -439,59 +651,26 @@ async def cmd_start(message: Message):
         "🎤 **Чтобы сделать отчет, запишите голосовым сообщением ваше впечатление о работе ученика по следующим пунктам.**\n"
     )
     
-    await message.answer(greeting, parse_mode="Markdown", reply_markup=create_main_keyboard())
+    await message.answer(greeting, parse_mode="Markdown", reply_markup=MAIN_KB)
     
     # Структура отчёта
-    structure_text = (
-        "📋 **Структура отчёта (8 пунктов):**\n\n"
-        "**1. Работа ученика на занятиях.** Общее впечатление за месяц "
-        "(вовлеченность в процесс занятия, каким образом проявлял активность за месяц)\n\n"
-        "**2. Работа с домашними заданиями** (впечатление от качества выполнения домашних заданий за месяц)\n\n"
-        "**3. Комментарий к экзаменационной работе**\n\n"
-        "**4. Ожидаемый результат на этот месяц**\n\n"
-        "**5. Причины отсутствия прироста и неудовлетворительного результата**\n\n"
-        "**6. Рекомендации на будущий месяц ребёнку**\n\n"
-        "**7. Рекомендации родителям**\n\n"
-        "**8. Дополнительные комментарии**\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        "⚠️ **Важно:**\n"
-        "• Обязательно скажите, **про кого идет речь** и **какой месяц**.\n"
-        "• Отчёт получится лучше, если будете записывать **с экзаменационной работой на руках**.\n"
-        "• Старайтесь рассказывать подробно **в баллах** и **в номерах заданий** — обязательно упомяните."
-    )
-    
-    await message.answer(structure_text, parse_mode="Markdown")
+    await message.answer(REPORT_STRUCTURE_TEXT, parse_mode="Markdown")
 
 
 @dp.message(F.text == "➡️ Следующий ученик")
 async def handle_clear_history(message: Message):
     """Обработчик кнопки перехода к следующему ученику"""
     user_id = message.from_user.id
-    clear_history(user_id)
+    await clear_history(user_id)
     
     await message.answer(
         "✅ Переходим к следующему ученику!\n\n"
         "История предыдущего отчёта очищена.",
-        reply_markup=create_main_keyboard()
+        reply_markup=MAIN_KB
     )
     
     # Показываем структуру отчёта снова
-    structure_text = (
-        "📋 **Структура отчёта (8 пунктов):**\n\n"
-        "1. Работа ученика на занятиях\n"
-        "2. Работа с домашними заданиями\n"
-        "3. Комментарий к экзаменационной работе\n"
-        "4. Ожидаемый результат на этот месяц\n"
-        "5. Причины отсутствия прироста\n"
-        "6. Рекомендации ребёнку\n"
-        "7. Рекомендации родителям\n"
-        "8. Дополнительные комментарии\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        "💬 **Какой месяц отчёта?**\n"
-        "💬 **Как зовут ученика?**"
-    )
-    
-    await message.answer(structure_text, parse_mode="Markdown")
+    await message.answer(REPORT_STRUCTURE_SHORT_TEXT, parse_mode="Markdown")
 
 
 @dp.message(F.text == "📊 Экспорт в Excel")
@@ -499,75 +678,68 @@ async def handle_export_excel(message: Message):
     """Обработчик кнопки экспорта в Excel"""
     user_id = message.from_user.id
     
-    history = get_conversation_history(user_id)
+    state = await get_user_state(user_id)
     
-    logger.info(f"Экспорт Excel для пользователя {user_id}, история: {len(history)} сообщений")
+    logger.info("Экспорт Excel для пользователя %s, история: %d сообщений", user_id, len(state.history))
     
-    if not history:
+    if not state.history:
         await message.answer(
             "❌ История пуста! Нечего экспортировать.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
         return
     
     # Проверяем наличие финального отчёта
-    has_final_report = False
-    for msg in reversed(history):
-        if msg['role'] == 'assistant' and '1.' in msg['content'] and '8.' in msg['content']:
-            has_final_report = True
-            logger.info(f"Найден финальный отчёт длиной {len(msg['content'])} символов")
-            logger.info(f"Первые 200 символов: {msg['content'][:200]}")
-            break
-    
-    if not has_final_report:
+    if not state.final_report:
         await message.answer(
             "❌ Финальный отчёт еще не создан!\n\n"
             "Пожалуйста, заполните все 8 пунктов отчёта в диалоге с ботом, "
             "затем попробуйте экспорт снова.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
         return
     
-    await message.answer("⏳ Формирую отчёт в Excel, подождите...")
+    logger.info("Найден финальный отчёт длиной %d символов", len(state.final_report))
+    logger.debug("Первые 200 символов: %.200s", state.final_report)
+    
+    # Статус отправляется параллельно с формированием файла
+    status_task = asyncio.create_task(message.answer("⏳ Формирую отчёт в Excel, подождите..."))
     
     # Создаем Excel файл
-    filename = await export_to_excel(user_id)
+    export = await export_to_excel(user_id)
+    
+    # Дожидаемся статуса, чтобы он не оказался в чате после файла
+    await status_task
     
-    if filename:
+    if export:
+        data, filename = export
         try:
-            # Извлекаем имя ученика из названия файла для подписи
-            student_name_from_file = None
-            if filename.startswith("ОТЧЕТ_") and not filename.split("_")[1].isdigit():
-                student_name_from_file = filename.replace("ОТЧЕТ_", "").replace(".xlsx", "")
-            
             # Формируем красивую подпись
             caption = "📊 Отчёт преподавателя"
-            if student_name_from_file:
-                caption += f" - {student_name_from_file}"
+            if state.student_name:
+                caption += f" - {state.student_name.upper()}"
             caption += f"\n📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}"
             
-            # Отправляем файл
-            file = FSInputFile(filename)
+            # Отправляем файл прямо из памяти
+            file = BufferedInputFile(data, filename=filename)
             await message.answer_document(
                 document=file,
                 caption=caption,
-                reply_markup=create_main_keyboard()
+                reply_markup=MAIN_KB
             )
             
-            # Удаляем временный файл
-            os.remove(filename)
-            logger.info(f"Excel файл {filename} отправлен и удален")
+            logger.info("Excel файл %s отправлен", filename)
             
         except Exception as e:
-            logger.error(f"Ошибка при отправке Excel файла: {e}")
+            logger.error("Ошибка при отправке Excel файла: %s", e)
             await message.answer(
                 "❌ Произошла ошибка при отправке файла. Попробуйте позже.",
-                reply_markup=create_main_keyboard()
+                reply_markup=MAIN_KB
             )
     else:
         await message.answer(
             "❌ Произошла ошибка при создании Excel файла. Попробуйте позже.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
 
 
@@ -575,11 +747,11 @@ async def handle_export_excel(message: Message):
 async def cmd_clear(message: Message):
     """Обработчик команды /clear - очистка истории диалога"""
     user_id = message.from_user.id
-    clear_history(user_id)
+    await clear_history(user_id)
     await message.answer(
         "🗑️ История диалога очищена!\n\n"
         "Начинаем разговор с чистого листа.",
-        reply_markup=create_main_keyboard()
+        reply_markup=MAIN_KB
     )
 
 
@@ -587,31 +759,28 @@ async def cmd_clear(message: Message):
 async def cmd_history(message: Message):
     """Обработчик команды /history - показать информацию об истории"""
     user_id = message.from_user.id
-    history = get_conversation_history(user_id)
+    state = await get_user_state(user_id)
     
-    if not history:
+    if not state.history:
         await message.answer(
             "📭 История диалога пуста.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
         return
     
-    user_msgs = sum(1 for msg in history if msg['role'] == 'user')
-    assistant_msgs = sum(1 for msg in history if msg['role'] == 'assistant')
-    
     await message.answer(
         f"📊 История диалога:\n\n"
-        f"💬 Ваших сообщений: {user_msgs}\n"
-        f"🤖 Ответов бота: {assistant_msgs}\n"
-        f"📝 Всего в контексте: {len(history)} сообщений",
-        reply_markup=create_main_keyboard()
+        f"💬 Ваших сообщений: {state.user_msgs}\n"
+        f"🤖 Ответов бота: {state.assistant_msgs}\n"
+        f"📝 Всего в контексте: {len(state.history)} сообщений",
+        reply_markup=MAIN_KB
     )
 
 
 @dp.message(F.voice)
 async def handle_voice(message: Message):
     """Обработчик голосовых сообщений"""
-    logger.info(f"Получено голосовое сообщение от пользователя {message.from_user.id}")
+    logger.info("Получено голосовое сообщение от пользователя %s", message.from_user.id)
     
     # Проверяем наличие Groq API ключа
     if not GROQ_API_KEY or GROQ_API_KEY == "your_groq_api_key_here":
@@ -621,7 +790,7 @@ async def handle_voice(message: Message):
             "1. Получить БЕСПЛАТНЫЙ Groq API ключ: https://console.groq.com/keys\n"
             "2. Добавить его в .env файл: GROQ_API_KEY=ваш_ключ\n\n"
             "💬 А пока отправьте ваш вопрос текстом!",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
         return
     
@@ -629,77 +798,83 @@ async def handle_voice(message: Message):
         await message.answer(
             "❌ Извините, бот не настроен правильно. "
             "Системный промпт не загружен. Обратитесь к администратору.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
         return
     
     try:
-        # Отправляем статус "печатает..."
-        await message.answer("🎤 Обрабатываю голосовое сообщение...")
+        # Отправляем статус и параллельно запрашиваем метаданные файла
+        _, file = await asyncio.gather(
+            message.answer("🎤 Обрабатываю голосовое сообщение..."),
+            bot.get_file(message.voice.file_id)
+        )
         
-        # Скачиваем голосовое сообщение
-        file = await bot.get_file(message.voice.file_id)
-        file_path = f"voice_{message.voice.file_id}.oga"
-        await bot.download_file(file.file_path, file_path)
+        # Скачиваем голосовое сообщение в память, минуя диск
+        audio_buffer = await bot.download_file(file.file_path)
+        audio_data = audio_buffer.getvalue()
         
-        logger.info(f"Голосовое сообщение скачано: {file_path}")
+        logger.info("Голосовое сообщение скачано: %d байт", len(audio_data))
         
-        # Транскрибируем аудио через OpenAI Whisper
-        text = await transcribe_audio(file_path)
+        # Транскрибируем аудио через Groq Whisper
+        text = await transcribe_audio(audio_data)
         
         if not text:
             await message.answer(
                 "❌ Не удалось распознать речь. Попробуйте еще раз или отправьте текстовое сообщение.",
-                reply_markup=create_main_keyboard()
+                reply_markup=MAIN_KB
             )
             return
         
-        logger.info(f"Транскрибированный текст: {text}")
+        logger.debug("Транскрибированный текст: %s", text)
         
         # Получаем ответ от LLM с учетом истории
         user_id = message.from_user.id
-        response = await get_llm_response(user_id, text)
+        reply = StreamingReply(message)
+        response = await get_llm_response(user_id, text, on_delta=reply.add)
         
         if response:
-            # Отправляем только ответ бота (без расшифровки)
-            await send_long_message(message, response)
+            # Дописываем остаток ответа бота (без расшифровки)
+            await reply.flush(final=True)
         else:
             await message.answer(
                 "❌ Произошла ошибка при обработке запроса. Попробуйте позже.",
-                reply_markup=create_main_keyboard()
+                reply_markup=MAIN_KB
             )
             await message.answer(
                 "❌ Произошла ошибка при обработке запроса. Попробуйте позже."
             )
             
     except Exception as e:
-        logger.error(f"Ошибка при обработке голосового сообщения: {e}")
+        logger.error("Ошибка при обработке голосового сообщения: %s", e)
         await message.answer(
             "❌ Произошла ошибка при обработке голосового сообщения. Попробуйте еще раз.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
 
 
-async def send_long_message(message: Message, text: str) -> None:
+def split_message(text: str) -> List[str]:
     """
-    Отправляет длинное сообщение, разбивая его на части если нужно.
+    Разбивает текст на части не длиннее MESSAGE_PART_LENGTH по границам строк.
     
     Args:
-        message: Объект сообщения Telegram
-        text: Текст для отправки
+        text: Текст для разбиения
+        
+    Returns:
+        Список частей текста
     """
-    MAX_MESSAGE_LENGTH = 4096
-    
-    if len(text) <= MAX_MESSAGE_LENGTH:
-        await message.answer(text)
-        return
-    
-    # Разбиваем на части по 4000 символов (оставляем запас)
     parts = []
     current_part = ""
     
     for line in text.split('\n'):
-        if len(current_part) + len(line) + 1 <= 4000:
+        # Слишком длинную строку режем по лимиту
+        while len(line) > MESSAGE_PART_LENGTH:
+            if current_part:
+                parts.append(current_part)
+                current_part = ""
+            parts.append(line[:MESSAGE_PART_LENGTH])
+            line = line[MESSAGE_PART_LENGTH:]
+        
+        if len(current_part) + len(line) + 1 <= MESSAGE_PART_LENGTH:
             current_part += line + '\n'
         else:
             if current_part:
@@ -709,41 +884,110 @@ async def send_long_message(message: Message, text: str) -> None:
     if current_part:
         parts.append(current_part)
     
-    # Отправляем части
-    for i, part in enumerate(parts, 1):
-        prefix = f"📄 Часть {i}/{len(parts)}:\n\n" if len(parts) > 1 else ""
-        await message.answer(prefix + part)
-        await asyncio.sleep(0.5)  # Небольшая задержка между сообщениями
+    return parts
+
+
+class StreamingReply:
+    """
+    Выводит ответ LLM в чат по мере генерации.
+    
+    Отправленные сообщения редактируются на месте; когда текст превышает
+    MESSAGE_PART_LENGTH, продолжение отправляется следующим сообщением.
+    """
+    
+    def __init__(self, message: Message):
+        self.message = message
+        self.chunks: List[str] = []  # Полученные фрагменты ответа
+        self.pending_chars = 0  # Символов получено с последнего обновления чата
+        self.sent: List[Message] = []  # Отправленные сообщения с частями ответа
+        self.sent_texts: List[str] = []  # Текущий текст каждого отправленного сообщения
+        self.last_update = 0.0
+    
+    async def add(self, delta: str) -> None:
+        """Принимает новый фрагмент ответа и при необходимости обновляет чат"""
+        self.chunks.append(delta)
+        self.pending_chars += len(delta)
+        
+        # Обновляем не чаще STREAM_EDIT_INTERVAL, на границе предложения или после большого куска текста
+        if time.monotonic() - self.last_update < STREAM_EDIT_INTERVAL:
+            return
+        if self.pending_chars < MESSAGE_PART_LENGTH and not any(ch in delta for ch in '.!?\n'):
+            return
+        
+        await self.flush()
+    
+    async def flush(self, final: bool = False) -> None:
+        """
+        Приводит сообщения в чате к уже полученному тексту ответа.
+        
+        Ошибки Telegram не прерывают генерацию: обновление пропускается,
+        а чат догоняет ответ при следующем вызове.
+        
+        Args:
+            final: Последнее обновление — при flood control ждём и повторяем
+        """
+        try:
+            await self._sync()
+        except TelegramRetryAfter as e:
+            logger.warning("Flood control Telegram при выводе ответа, пауза %d с", e.retry_after)
+            if not final:
+                # Следующее промежуточное обновление — не раньше, чем разрешит Telegram
+                self.last_update = time.monotonic() + e.retry_after
+                return
+            await asyncio.sleep(e.retry_after)
+            try:
+                await self._sync()
+            except TelegramAPIError as retry_error:
+                logger.error("Ошибка Telegram при выводе ответа: %s", retry_error)
+        except TelegramAPIError as e:
+            logger.error("Ошибка Telegram при выводе ответа: %s", e)
+        
+        self.pending_chars = 0
+        self.last_update = max(self.last_update, time.monotonic())
+    
+    async def _sync(self) -> None:
+        """Отправляет новые части ответа и редактирует изменившиеся"""
+        parts = [part.strip() for part in split_message(''.join(self.chunks))]
+        parts = [part for part in parts if part]
+        
+        for i, part in enumerate(parts):
+            if i < len(self.sent):
+                if part != self.sent_texts[i]:
+                    await self.sent[i].edit_text(part)
+                    self.sent_texts[i] = part
+            else:
+                self.sent.append(await self.message.answer(part))
+                self.sent_texts.append(part)
 
 
 @dp.message(F.photo)
 async def handle_photo(message: Message):
     """Обработчик фотографий"""
     user_id = message.from_user.id
-    logger.info(f"Получено фото от пользователя {user_id}")
+    logger.info("Получено фото от пользователя %s", user_id)
     
     try:
         # Информируем о получении фото
         await message.answer(
             "📷 Фото получено! Можете добавить текстовый или голосовой комментарий.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
         
         # Добавляем информацию о фото в историю
-        photo_info = "[Пользователь отправил фото экзаменационной работы/материала]"
+        photo_info = PHOTO_MARKER
         if message.caption:
             photo_info += f"\nПодпись к фото: {message.caption}"
         
         # Добавляем в историю диалога
-        add_to_history(user_id, "user", photo_info)
+        await add_to_history(user_id, "user", photo_info)
         
-        logger.info(f"Фото добавлено в историю пользователя {user_id}")
+        logger.info("Фото добавлено в историю пользователя %s", user_id)
         
     except Exception as e:
-        logger.error(f"Ошибка при обработке фото: {e}")
+        logger.error("Ошибка при обработке фото: %s", e)
         await message.answer(
             "❌ Произошла ошибка при обработке фото. Попробуйте еще раз.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
 
 
@@ -751,13 +995,13 @@ async def handle_photo(message: Message):
 async def handle_text(message: Message):
     """Обработчик текстовых сообщений"""
     user_id = message.from_user.id
-    logger.info(f"Получено текстовое сообщение от пользователя {user_id}")
+    logger.info("Получено текстовое сообщение от пользователя %s", user_id)
     
     if not SYSTEM_PROMPT:
         await message.answer(
             "❌ Извините, бот не настроен правильно. "
             "Системный промпт не загружен. Обратитесь к администратору.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
         return
     
@@ -766,27 +1010,30 @@ async def handle_text(message: Message):
         await message.chat.do("typing")
         
         # Получаем ответ от LLM с учетом истории диалога
-        response = await get_llm_response(user_id, message.text)
+        reply = StreamingReply(message)
+        response = await get_llm_response(user_id, message.text, on_delta=reply.add)
         
         if response:
-            # Отправляем ответ (с автоматическим разбиением на части если нужно)
-            await send_long_message(message, response)
+            # Дописываем остаток ответа (с автоматическим разбиением на части если нужно)
+            await reply.flush(final=True)
         else:
             await message.answer(
                 "❌ Произошла ошибка при обработке запроса. Попробуйте позже.",
-                reply_markup=create_main_keyboard()
+                reply_markup=MAIN_KB
             )
             
     except Exception as e:
-        logger.error(f"Ошибка при обработке текстового сообщения: {e}")
+        logger.error("Ошибка при обработке текстового сообщения: %s", e)
         await message.answer(
             "❌ Произошла ошибка при обработке сообщения. Попробуйте еще раз.",
-            reply_markup=create_main_keyboard()
+            reply_markup=MAIN_KB
         )
 
 
 async def main():
     """Главная функция запуска бота"""
+    global HTTP
+    
     # Проверяем наличие необходимых переменных окружения
     if not TELEGRAM_BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN не установлен в .env файле!")
@@ -804,28 +1051,28 @@ async def main():
     # Проверяем настройки голосовых сообщений
     if GROQ_API_KEY and GROQ_API_KEY != "your_groq_api_key_here":
         logger.info("✅ Groq API ключ обнаружен - голосовые сообщения включены (БЕСПЛАТНО!)")
-        # Проверяем наличие ffmpeg
-        try:
-            import shutil
-            ffmpeg_path = shutil.which('ffmpeg')
-            if ffmpeg_path:
-                logger.info(f"✅ ffmpeg установлен - обработка аудио доступна ({ffmpeg_path})")
-            else:
-                logger.warning("⚠️  ffmpeg не найден! Голосовые сообщения не будут работать.")
-                logger.warning("   Установите: apt install ffmpeg (на Ubuntu/Debian)")
-        except Exception as e:
-            logger.warning(f"⚠️  Ошибка проверки ffmpeg: {e}")
     else:
         logger.warning("⚠️  Groq API ключ не установлен - голосовые сообщения отключены")
         logger.warning("   Получите БЕСПЛАТНЫЙ ключ: https://console.groq.com/keys")
     
-    logger.info(f"Запуск бота с моделью: {OPENROUTER_MODEL}")
+    logger.info("Запуск бота с моделью: %s", OPENROUTER_MODEL)
     logger.info("Бот готов к работе!")
     
+    # Открываем хранилище истории диалогов
+    await conv_store.init(CONVERSATIONS_DB, MAX_HISTORY_MESSAGES)
+    
+    # Общая HTTP-сессия: keep-alive и пул соединений к OpenRouter и Groq
+    HTTP = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=120),
+        connector=aiohttp.TCPConnector(limit=50, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+    
     # Запускаем polling
     try:
         await dp.start_polling(bot)
     finally:
+        await HTTP.close()
+        await conv_store.close()
         await bot.session.close()
 
 
@@ -0,0 +1,139 @@
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Соединение с базой данных (открывается в init())
+_db: Optional[aiosqlite.Connection] = None
+
+# Сколько последних сообщений хранить для каждого пользователя (задаётся в init())
+_max_messages = 0
+
+
+async def init(db_path: str, max_messages: int) -> None:
+    """
+    Открывает базу данных SQLite и создает таблицы истории, если их нет.
+    
+    Args:
+        db_path: Путь к файлу базы данных
+        max_messages: Сколько последних сообщений хранить для каждого пользователя
+    """
+    global _db, _max_messages
+    
+    _max_messages = max_messages
+    _db = await aiosqlite.connect(db_path)
+    await _db.execute(
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "user_id INTEGER NOT NULL, "
+        "ts REAL NOT NULL, "
+        "role TEXT NOT NULL, "
+        "content TEXT NOT NULL)"
+    )
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages (user_id, ts)")
+    # Данные для экспорта отчёта хранятся отдельно: они должны пережить вытеснение старых сообщений
+    await _db.execute(
+        "CREATE TABLE IF NOT EXISTS user_meta ("
+        "user_id INTEGER PRIMARY KEY, "
+        "student_name TEXT, "
+        "final_report TEXT)"
+    )
+    await _db.commit()
+    logger.info("Хранилище диалогов открыто: %s", db_path)
+
+
+async def close() -> None:
+    """Закрывает соединение с базой данных"""
+    global _db
+    
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+
+async def append(user_id: int, msg: Dict[str, str]) -> None:
+    """
+    Сохраняет сообщение в историю пользователя и удаляет выходящие за лимит старые.
+    
+    Args:
+        user_id: ID пользователя Telegram
+        msg: Сообщение в формате {"role": "user/assistant", "content": "..."}
+    """
+    await _db.execute(
+        "INSERT INTO messages (user_id, ts, role, content) VALUES (?, ?, ?, ?)",
+        (user_id, time.time(), msg['role'], msg['content'])
+    )
+    await _db.execute(
+        "DELETE FROM messages WHERE user_id = ? AND rowid NOT IN ("
+        "SELECT rowid FROM messages WHERE user_id = ? ORDER BY ts DESC, rowid DESC LIMIT ?)",
+        (user_id, user_id, _max_messages)
+    )
+    await _db.commit()
+
+
+async def fetch(user_id: int) -> List[Dict[str, str]]:
+    """
+    Загружает последние сообщения пользователя (не больше лимита из init()).
+    
+    Args:
+        user_id: ID пользователя Telegram
+    
+    Returns:
+        Список сообщений от старых к новым в формате [{"role": "user/assistant", "content": "..."}]
+    """
+    async with _db.execute(
+        "SELECT role, content FROM messages WHERE user_id = ? ORDER BY ts DESC, rowid DESC LIMIT ?",
+        (user_id, _max_messages)
+    ) as cursor:
+        rows = await cursor.fetchall()
+    return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+
+async def save_meta(user_id: int, student_name: Optional[str], final_report: Optional[str]) -> None:
+    """
+    Сохраняет имя ученика и финальный отчёт пользователя.
+    
+    Args:
+        user_id: ID пользователя Telegram
+        student_name: Имя ученика или None
+        final_report: Текст финального отчёта или None
+    """
+    await _db.execute(
+        "INSERT INTO user_meta (user_id, student_name, final_report) VALUES (?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET "
+        "student_name = excluded.student_name, final_report = excluded.final_report",
+        (user_id, student_name, final_report)
+    )
+    await _db.commit()
+
+
+async def fetch_meta(user_id: int) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """
+    Загружает имя ученика и финальный отчёт пользователя.
+    
+    Args:
+        user_id: ID пользователя Telegram
+    
+    Returns:
+        Кортеж (имя ученика, финальный отчёт) или None, если данных нет
+    """
+    async with _db.execute(
+        "SELECT student_name, final_report FROM user_meta WHERE user_id = ?",
+        (user_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    return tuple(row) if row else None
+
+
+async def clear(user_id: int) -> None:
+    """
+    Удаляет историю пользователя вместе с данными для экспорта.
+    
+    Args:
+        user_id: ID пользователя Telegram
+    """
+    await _db.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+    await _db.execute("DELETE FROM user_meta WHERE user_id = ?", (user_id,))
+    await _db.commit()